@@ -0,0 +1,472 @@
+import argparse
+import json
+import os
+import pickle
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import traceback
+from collections import OrderedDict
+from multiprocessing import Process, Queue as ProcessQueue
+from random import Random
+from threading import Thread
+from timeit import default_timer as timer
+
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
+import blackboard
+import blackboard_concurrent
+import data_access_object
+import dynamic_object_model
+import object_request_broker
+import pipesandfilters
+
+
+def make_work(kind, scale):
+    """
+    Returns a replacement for `sleep` doing synthetic work for the given
+    number of seconds, multiplied by `scale`
+    """
+
+    if kind == 'io':
+        def work(seconds):
+            time.sleep(seconds * scale)
+    elif kind == 'cpu':
+        def work(seconds):
+            end = timer() + seconds * scale
+            while timer() < end:
+                pass
+    else:
+        def work(seconds):
+            pass
+    return work
+
+
+class _TimedChairs(list):
+    """
+    Chair list which records, when a chair is removed (i.e. completed), how
+    long ago a worker first started working on it
+    """
+
+    def __init__(self, chairs):
+        super(_TimedChairs, self).__init__(chairs)
+        self.latencies = []
+
+    def remove(self, chair):
+        self.latencies.append(timer() - chair.started)
+        super(_TimedChairs, self).remove(chair)
+
+
+def _timed(worker_class):
+    """
+    Returns a subclass of given blackboard worker which stamps chairs with
+    the time work on them started
+    """
+
+    class TimedWorker(worker_class):
+        def work(self, chair):
+            if not hasattr(chair, 'started'):
+                chair.started = timer()
+            super(TimedWorker, self).work(chair)
+    return TimedWorker
+
+
+def bench_pipe(size, work, rng):
+    pipesandfilters.sleep = work
+    pipe = pipesandfilters.Pipe(workers=(
+        pipesandfilters.SeatCutter('john', 2),
+        pipesandfilters.FeetAssembler('travis', 1),
+        pipesandfilters.BackrestAssembler('james', 3),
+        pipesandfilters.StabilizerBarAssembler('oliver', 1),
+        pipesandfilters.ChairPackager('donald', 4)))
+
+    latencies = []
+    begin = timer()
+    for _ in range(size):
+        start = timer()
+        pipe.run([pipesandfilters.Chair()])
+        latencies.append(timer() - start)
+    return latencies, timer() - begin
+
+
+def bench_blackboard(size, work, rng):
+    blackboard.sleep = work
+    blackboard.choice = rng.choice
+    blackboard.shuffle = rng.shuffle
+    chairs = _TimedChairs([blackboard.Chair() for _ in range(size)])
+    controller = blackboard.Controller(
+        blackboard.Blackboard(chairs),
+        workers=[_timed(blackboard.SeatCutter)('john', 2),
+                 _timed(blackboard.FeetAssembler)('travis', 1),
+                 _timed(blackboard.BackrestAssembler)('james', 3),
+                 _timed(blackboard.StabilizerBarAssembler)('oliver', 1),
+                 _timed(blackboard.ChairPackager)('donald', 4)])
+
+    start = timer()
+    controller.run()
+    return chairs.latencies, timer() - start
+
+
+def bench_blackboard_concurrent(size, work, rng):
+    blackboard_concurrent.sleep = work
+    chairs = _TimedChairs([blackboard_concurrent.Chair()
+                           for _ in range(size)])
+    board = blackboard_concurrent.Blackboard(chairs)
+
+    # Workers start running as soon as they are created
+    start = timer()
+    workers = [
+        _timed(blackboard_concurrent.SeatCutter)('john', 2, board),
+        _timed(blackboard_concurrent.FeetAssembler)('travis', 1, board),
+        _timed(blackboard_concurrent.BackrestAssembler)('james', 3, board),
+        _timed(blackboard_concurrent.StabilizerBarAssembler)('oliver', 1,
+                                                             board),
+        _timed(blackboard_concurrent.ChairPackager)('donald', 4, board)]
+    for worker in workers:
+        worker.join()
+    return chairs.latencies, timer() - start
+
+
+def bench_apply_rule(size, work, rng):
+    CarInsurance = dynamic_object_model.create_product('CarInsurance')
+    Age = dynamic_object_model.create_attribute('Age', 'age', int)
+    EnginePower = dynamic_object_model.create_attribute(
+        'EnginePower', 'engine_power', float)
+    CarInsurance.add_attribute(Age)
+    CarInsurance.add_attribute(EnginePower)
+    Add = dynamic_object_model.Add
+    Subtract = dynamic_object_model.Subtract
+    Multiply = dynamic_object_model.Multiply
+    CarInsurance.add_rule('price',
+        Add(Subtract(Multiply(1000, Age), Multiply(10, Age)),
+            Multiply(5, EnginePower)))
+
+    insurance = CarInsurance()
+    insurance.set_attribute('age', 20)
+    insurance.set_attribute('engine_power', 100.5)
+
+    latencies = []
+    begin = timer()
+    for _ in range(size):
+        start = timer()
+        insurance.apply_rule('price')
+        latencies.append(timer() - start)
+    return latencies, timer() - begin
+
+
+def bench_orb(size, work, rng):
+    # The broker leaves transport and marshalling abstract; plug in an
+    # in-process queue transport and pickle marshalling
+    requests, responses = Queue(), Queue()
+
+    class QueueRequestor(object_request_broker.Requestor):
+        @classmethod
+        def send(cls, message):
+            requests.put(message)
+
+        @classmethod
+        def receive(cls):
+            return responses.get()
+
+    class QueueReplyer(object_request_broker.Replyer):
+        @classmethod
+        def send(cls, message):
+            responses.put(message)
+
+        @classmethod
+        def receive(cls):
+            return requests.get()
+
+    class PickleMarshaller(object_request_broker.Marshaller):
+        @classmethod
+        def marshall(cls, *values):
+            return pickle.dumps(values, pickle.HIGHEST_PROTOCOL)
+
+        @classmethod
+        def unmarshall(cls, message):
+            values = pickle.loads(message)
+            if len(values) == 1:
+                return values[0]
+            return values[0], values[1:]
+
+    object_request_broker.Requestor = QueueRequestor
+    object_request_broker.Replyer = QueueReplyer
+    object_request_broker.Marshaller = PickleMarshaller
+
+    # Registering a server runs its proxy loop forever
+    broker = object_request_broker.Broker()
+    server = Thread(target=broker.register,
+                    args=(object_request_broker.MathServer(), 'math_server'))
+    server.daemon = True
+    server.start()
+    while 'math_server' not in broker.servers:
+        time.sleep(0.001)
+    proxy = broker.find('math_server')
+
+    latencies = []
+    begin = timer()
+    for i in range(size):
+        start = timer()
+        proxy.add(i, 1)
+        latencies.append(timer() - start)
+    return latencies, timer() - begin
+
+
+def _bench_dao(method, operations, by_nr=True):
+    """
+    Builds a benchmark calling given SQLiteHoroscopeDAO method, with a random
+    student's nr if `by_nr`, against a students database holding `size` rows
+    """
+
+    def bench(size, work, rng):
+        directory = tempfile.mkdtemp()
+        connection = sqlite3.connect(
+            os.path.join(directory, data_access_object.DB_NAME))
+        try:
+            data_access_object.init_db(connection)
+            dao = data_access_object.SQLiteHoroscopeDAO(connection)
+            nrs = [str(1000000 + i) for i in range(size)]
+            dao.add_students((nr, rng.choice(['John', 'Jenny', 'Clark']),
+                              rng.uniform(1, 10)) for nr in nrs)
+
+            latencies = []
+            begin = timer()
+            for _ in range(min(size, operations)):
+                args = (rng.choice(nrs),) if by_nr else ()
+                start = timer()
+                getattr(dao, method)(*args)
+                latencies.append(timer() - start)
+            return latencies, timer() - begin
+        finally:
+            connection.close()
+            shutil.rmtree(directory)
+    return bench
+
+
+# name: (benchmark, default size)
+BENCHMARKS = OrderedDict([
+    ('pipesandfilters.Pipe.run', (bench_pipe, 1000)),
+    ('blackboard.Controller.run', (bench_blackboard, 200)),
+    ('blackboard_concurrent.Worker', (bench_blackboard_concurrent, 200)),
+    ('dynamic_object_model.apply_rule', (bench_apply_rule, 100000)),
+    ('object_request_broker.round_trip', (bench_orb, 10000)),
+    ('data_access_object.grades_tendency',
+     (_bench_dao('grades_tendency', 10000), 100000)),
+    ('data_access_object.grade_8_lower_tendency',
+     (_bench_dao('grade_8_lower_tendency', 100, by_nr=False), 100000)),
+    ('data_access_object.good_day',
+     (_bench_dao('good_day', 10000), 100000)),
+])
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of given (sorted) values
+    """
+
+    if not values:
+        return None
+    index = max(0, int(round(fraction * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def median(values):
+    """
+    Median of given values
+    """
+
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _run(name, size, options, results):
+    # Each benchmark runs in its own process, so the patching done by
+    # benchmarks stays isolated and peak memory is measured per benchmark
+    sys.stdout = open(os.devnull, 'w')
+    bench = BENCHMARKS[name][0]
+    work = make_work(options['work'], options['work_scale'])
+
+    try:
+        # Warm up caches, imports and the allocator on a smaller run first
+        bench(max(1, size // 10), work, Random(options['seed']))
+        latencies, seconds = bench(size, work, Random(options['seed']))
+    except Exception:
+        results.put({'error': traceback.format_exc()})
+        return
+    latencies.sort()
+
+    results.put({
+        'operations': len(latencies),
+        'seconds': seconds,
+        'throughput': len(latencies) / seconds if seconds else 0.0,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+
+
+def _run_once(name, size, options, timeout=None):
+    results = ProcessQueue()
+    process = Process(target=_run, args=(name, size, options, results))
+    process.start()
+    deadline = timer() + timeout if timeout else None
+
+    # Read before joining, a child blocked on a full queue never exits. Poll
+    # rather than block, the child may also die or hang without posting
+    while True:
+        try:
+            result = results.get(timeout=0.1)
+            break
+        except Empty:
+            pass
+        if not process.is_alive():
+            try:
+                # Posted right before exiting
+                result = results.get(timeout=1)
+            except Empty:
+                result = {'error': 'Benchmark process exited with code %s '
+                                   'without a result' % process.exitcode}
+            break
+        if deadline and timer() > deadline:
+            process.terminate()
+            result = {'error': 'Benchmark timed out after %ss' % timeout}
+            break
+    process.join()
+    return result
+
+
+def run(names, options, timeout=None):
+    """
+    Runs each of given benchmarks `repeat` times and returns a report of
+    the median of their results. Runs taking over `timeout` seconds are
+    aborted
+    """
+
+    report = {'options': options, 'results': OrderedDict()}
+    for name in names:
+        size = int(BENCHMARKS[name][1] * options['scale'])
+        print 'Running %s (size %s, %s runs)...' % (name, size,
+                                                    options['repeat'])
+        runs = [_run_once(name, size, options, timeout)
+                for _ in range(options['repeat'])]
+        errors = [result['error'] for result in runs if 'error' in result]
+        if errors:
+            report['results'][name] = {'size': size, 'error': errors[0]}
+            print '  Failed:\n%s' % errors[0]
+            continue
+
+        result = {'size': size, 'runs': runs}
+        for metric in ('operations', 'seconds', 'throughput', 'p50', 'p99'):
+            result[metric] = median([run[metric] for run in runs])
+        result['peak_rss_kb'] = max(run['peak_rss_kb'] for run in runs)
+        report['results'][name] = result
+        print '  %.1f ops/s, p50 %.6fs, p99 %.6fs, peak %s KB' % (
+              result['throughput'], result['p50'], result['p99'],
+              result['peak_rss_kb'])
+    return report
+
+
+def _change(old, new):
+    """
+    Relative change from `old` to `new`
+    """
+
+    if not old:
+        return 0.0
+    return float(new) / old - 1
+
+
+def compare(baseline, report, threshold, metrics=('throughput', 'p50')):
+    """
+    Compares a report against a baseline one and returns the names of the
+    benchmarks where any of given metrics regressed by more than `threshold`
+    (a fraction)
+    """
+
+    if baseline['options'] != report['options']:
+        print 'Warning: baseline was run with different options ' \
+              '(%s)' % baseline['options']
+
+    regressions = []
+    for name, result in report['results'].items():
+        old = baseline['results'].get(name)
+        if not old or 'error' in old or 'error' in result:
+            continue
+        changes = {
+            'throughput': _change(old['throughput'], result['throughput']),
+            # Latency going down is an improvement; flip the sign
+            'p50': -_change(old['p50'], result['p50']),
+            'p99': -_change(old['p99'], result['p99']),
+        }
+        regressed = [metric for metric in metrics
+                     if changes[metric] < -threshold]
+        print '%s: throughput %+.1f%%, p50 %+.1f%%, p99 %+.1f%%%s' % (
+              name, changes['throughput'] * 100, changes['p50'] * 100,
+              changes['p99'] * 100,
+              ' REGRESSION (%s)' % ', '.join(regressed) if regressed else '')
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the architecture modules')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='benchmarks to run (default: all of %s)' %
+                             ', '.join(BENCHMARKS))
+    parser.add_argument('--work', choices=['cpu', 'io', 'none'],
+                        default='cpu',
+                        help='synthetic work replacing `sleep` in workers')
+    parser.add_argument('--work-scale', type=float, default=0.0001,
+                        help='seconds of work per second of worker time')
+    parser.add_argument('--scale', type=float, default=1,
+                        help='multiplier applied to default sizes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds after which a single run is aborted '
+                             '(0 for no limit)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark; medians are reported')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='file the JSON report is written to')
+    parser.add_argument('--baseline',
+                        help='JSON report to compare results against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change counted as a regression')
+    parser.add_argument('--metrics', default='throughput,p50',
+                        help='comma separated metrics checked for '
+                             'regressions, among throughput, p50 and p99')
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark `%s`' % name)
+    metrics = args.metrics.split(',')
+    for metric in metrics:
+        if metric not in ('throughput', 'p50', 'p99'):
+            parser.error('Unknown metric `%s`' % metric)
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+
+    options = {'work': args.work, 'work_scale': args.work_scale,
+               'scale': args.scale, 'seed': args.seed,
+               'repeat': args.repeat}
+    report = run(args.benchmarks or list(BENCHMARKS), options, args.timeout)
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            if compare(json.load(baseline), report, args.threshold,
+                       metrics):
+                sys.exit(1)
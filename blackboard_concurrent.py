@@ -44,7 +44,11 @@ class Worker(Thread):
 
     def run(self):
         while self.blackboard.chairs:
-            chair = choice(self.blackboard.chairs)
+            try:
+                chair = choice(self.blackboard.chairs)
+            except IndexError:
+                # Another worker finished the last chair in the meantime
+                break
             # Search for another chair is this one is currently locked
             if chair.lock.acquire(False):
                 try:
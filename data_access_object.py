@@ -1,10 +1,37 @@
+from __future__ import print_function
+
+import csv
 import datetime
 import os
 import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from itertools import islice
+from threading import Thread
+
+try:
+    import asyncio
+except ImportError:
+    # Python 2 has no asyncio; AsyncHoroscopeDAO then relies on trollius
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 
 DB_NAME = 'students.db'
 
+# Expression backing the `tendency` column; kept as a generated column so it
+# can be indexed instead of being recomputed on every query
+TENDENCY = """(CASE WHEN (LENGTH(name)+LENGTH(nr)) % 2 = 1
+                 then 'higher' else 'lower' end)"""
+
 
 class HoroscopeDAO(object):
     def __init__(self, connection):
@@ -31,13 +58,18 @@ class HoroscopeDAO(object):
 
         raise NotImplementedError()
 
+    def add_students(self, students):
+        """
+        Inserts (nr, name, grade) rows for new students
+        """
+
+        raise NotImplementedError()
+
 
 class SQLiteHoroscopeDAO(HoroscopeDAO):
     def grades_tendency(self, nr):
         cursor = self.connection.cursor()
-        cursor.execute("""SELECT name,
-                                 (CASE WHEN (LENGTH(name)+LENGTH(nr)) % 2 = 1
-                                    then 'higher' else 'lower' end) AS tendency
+        cursor.execute("""SELECT name, tendency
                           FROM students WHERE nr=?""", (nr,))
         result = cursor.fetchone()
         return result
@@ -46,9 +78,7 @@ class SQLiteHoroscopeDAO(HoroscopeDAO):
         cursor = self.connection.cursor()
         cursor.execute("""SELECT COUNT(*) AS tendency
                           FROM students
-                          WHERE (CASE WHEN (LENGTH(name)+LENGTH(nr)) % 2 = 1
-                                    then 'higher' else 'lower' end)='lower'
-                                AND grade>8""")
+                          WHERE tendency='lower' AND grade>8""")
         result = cursor.fetchone()
         return result
 
@@ -62,10 +92,336 @@ class SQLiteHoroscopeDAO(HoroscopeDAO):
             return (result[0], 'good')
         return (result[0], 'bad')
 
+    def add_students(self, students):
+        cursor = self.connection.cursor()
+        cursor.executemany("INSERT INTO students VALUES (?, ?, ?)", students)
+        self.connection.commit()
+
+
+class AsyncHoroscopeDAO(HoroscopeDAO):
+    """
+    Serves SQLiteHoroscopeDAO queries to an asyncio event loop without
+    blocking it. Requests are queued to a fixed pool of worker threads, each
+    owning its own connection to `database`, so at most `workers` queries hit
+    SQLite at once. Every method returns a future to be awaited
+    """
+
+    def __init__(self, database, workers=4, loop=None):
+        # There is no single connection; each worker thread opens its own.
+        # Hence `database` must be a file, not ':memory:'
+        if asyncio is None:
+            raise ImportError('AsyncHoroscopeDAO requires asyncio (or '
+                              'trollius on Python 2)')
+        super(AsyncHoroscopeDAO, self).__init__(None)
+        self.database = database
+        self.loop = loop
+        self.closed = False
+        self.requests = Queue()
+        self.workers = [Thread(target=self._serve) for _ in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def grades_tendency(self, nr):
+        return self._submit('grades_tendency', nr)
+
+    def grade_8_lower_tendency(self):
+        return self._submit('grade_8_lower_tendency')
+
+    def good_day(self, nr):
+        return self._submit('good_day', nr)
+
+    def add_students(self, students):
+        return self._submit('add_students', students)
+
+    def close(self):
+        """
+        Stops the worker threads once queued requests are served and closes
+        their connections. No requests are accepted afterwards
+        """
+
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def _submit(self, method, *args):
+        if self.closed:
+            raise RuntimeError('AsyncHoroscopeDAO is closed')
+        # get_event_loop() is deprecated on Python 3 outside a running loop
+        loop = self.loop or getattr(asyncio, 'get_running_loop',
+                                    asyncio.get_event_loop)()
+        future = asyncio.Future(loop=loop)
+        self.requests.put((loop, future, method, args))
+        return future
+
+    def _serve(self):
+        dao = SQLiteHoroscopeDAO(sqlite3.connect(self.database))
+        try:
+            while True:
+                request = self.requests.get()
+                if request is None:
+                    break
+                loop, future, method, args = request
+                result = exception = None
+                try:
+                    result = getattr(dao, method)(*args)
+                except Exception as e:
+                    exception = e
+                try:
+                    loop.call_soon_threadsafe(_resolve, future, result,
+                                              exception)
+                except RuntimeError:
+                    # The caller's loop is closed; nobody is left to notify
+                    pass
+        finally:
+            dao.connection.close()
+
+
+def _resolve(future, result, exception):
+    """
+    Completes a future handed out by AsyncHoroscopeDAO, unless the caller
+    has given up on it in the meantime
+    """
+
+    if future.cancelled():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+class CachingHoroscopeDAO(HoroscopeDAO):
+    """
+    Read-through LRU cache in front of another (synchronous) HoroscopeDAO.
+    Entries live for at most `ttl` seconds, except good_day() ones which
+    expire at midnight, when the day they were computed for ends. Adding
+    students through this DAO evicts the entries they affect, while the
+    grade_8_lower_tendency() count is also recomputed after writes made
+    around it, through the same connection or another one
+    """
+
+    def __init__(self, dao, max_entries=1024, ttl=None):
+        super(CachingHoroscopeDAO, self).__init__(dao.connection)
+        self.dao = dao
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+        self.table_state = None
+
+    def grades_tendency(self, nr):
+        return self._get(('grades_tendency', nr), self._expiry(),
+                         self.dao.grades_tendency, nr)
+
+    def grade_8_lower_tendency(self):
+        state = self._table_state()
+        if state is None or state != self.table_state:
+            self.invalidate(('grade_8_lower_tendency',))
+            self.table_state = state
+        return self._get(('grade_8_lower_tendency',), self._expiry(),
+                         self.dao.grade_8_lower_tendency)
+
+    def good_day(self, nr):
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        midnight = time.mktime(tomorrow.timetuple())
+        return self._get(('good_day', nr), min(self._expiry(), midnight),
+                         self.dao.good_day, nr)
+
+    def add_students(self, students):
+        students = list(students)
+        try:
+            return self.dao.add_students(students)
+        finally:
+            self.invalidate(('grade_8_lower_tendency',))
+            for student in students:
+                self.invalidate(('grades_tendency', student[0]),
+                                ('good_day', student[0]))
+
+    def invalidate(self, *keys):
+        """
+        Evicts given entries, or the whole cache if no keys are given
+        """
+
+        if not keys:
+            self.entries.clear()
+        for key in keys:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        """
+        Reports hit ratio and approximate memory used by cached entries
+        """
+
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+            'entries': len(self.entries),
+            'size': sys.getsizeof(self.entries) + sum(
+                _sizeof(key) + _sizeof(value)
+                for key, (value, _) in self.entries.items()),
+        }
+
+    def _table_state(self):
+        """
+        Changes whenever the database is written to: data_version tracks
+        commits by other connections, total_changes rows changed through
+        this one
+        """
+
+        connection = self.dao.connection
+        if connection is None:
+            return None
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA data_version")
+        return cursor.fetchone()[0], connection.total_changes
+
+    def _expiry(self):
+        if self.ttl is None:
+            return float('inf')
+        return time.time() + self.ttl
+
+    def _get(self, key, expires_at, method, *args):
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry[1] > time.time():
+            self.hits += 1
+            # Re-inserting marks the entry as most recently used
+            self.entries[key] = entry
+            return entry[0]
+
+        self.misses += 1
+        value = method(*args)
+        self.entries[key] = (value, expires_at)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return value
+
+
+def _sizeof(obj):
+    """
+    Size of an object plus, for tuples, the size of its items
+    """
+
+    if isinstance(obj, tuple):
+        return sys.getsizeof(obj) + sum(_sizeof(item) for item in obj)
+    return sys.getsizeof(obj)
+
+
+def migrate_db(connection):
+    """
+    Brings an existing students table up to date: adds the generated
+    `tendency` column and the indexes used by SQLiteHoroscopeDAO
+    """
+
+    _migrate(connection.cursor())
+    connection.commit()
+
+
+def _migrate(cursor):
+    """
+    Schema changes behind migrate_db(), left uncommitted
+    """
+
+    cursor.execute("PRAGMA table_xinfo(students)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if 'tendency' not in columns:
+        # Only VIRTUAL generated columns can be added to an existing table
+        cursor.execute("ALTER TABLE students ADD COLUMN tendency TEXT "
+                       "GENERATED ALWAYS AS %s VIRTUAL" % TENDENCY)
+    # Not unique, as the original schema allowed repeated student numbers
+    cursor.execute("CREATE INDEX IF NOT EXISTS students_nr ON students (nr)")
+    # Covers grade_8_lower_tendency(), which becomes an index-only count
+    cursor.execute("CREATE INDEX IF NOT EXISTS students_tendency_grade "
+                   "ON students (tendency, grade)")
+
+
+def load_students(connection, path, chunk_size=10000, skip_header=False):
+    """
+    Bulk loads (nr, name, grade) rows from a CSV file into the students table.
+    Rows are streamed in chunks, with durability pragmas relaxed for the
+    duration of the load, and indexes are rebuilt only once all rows are in.
+    Everything runs in a single transaction, so a malformed row leaves the
+    table as it was. Returns load statistics
+    """
+
+    # Pragmas below cannot be changed inside a transaction (Python 2 has no
+    # in_transaction to check this)
+    if getattr(connection, 'in_transaction', False):
+        raise RuntimeError('Cannot load students inside an open '
+                           'transaction, commit or roll it back first')
+
+    # Relaxed for the load only; restored afterwards
+    pragmas = {'synchronous': 'OFF', 'journal_mode': 'MEMORY',
+               'cache_size': -200000}
+    cursor = connection.cursor()
+    previous = {}
+
+    # Manage the transaction by hand, otherwise the sqlite3 module commits
+    # before DDL statements on Python 2
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    start = time.time()
+    rows = 0
+    try:
+        for pragma, value in pragmas.items():
+            cursor.execute("PRAGMA %s" % pragma)
+            current = cursor.fetchone()[0]
+            cursor.execute("PRAGMA %s=%s" % (pragma, value))
+            previous[pragma] = current
+
+        cursor.execute("BEGIN")
+        try:
+            cursor.execute("CREATE TABLE IF NOT EXISTS students "
+                           "(nr TEXT, name TEXT, grade REAL)")
+            # Maintaining indexes row by row is far slower than building
+            # them once at the end
+            cursor.execute("DROP INDEX IF EXISTS students_nr")
+            cursor.execute("DROP INDEX IF EXISTS students_tendency_grade")
+
+            if sys.version_info[0] < 3:
+                csv_file = open(path, 'rb')
+            else:
+                csv_file = open(path, newline='')
+            with csv_file:
+                reader = csv.reader(csv_file)
+                if skip_header:
+                    next(reader, None)
+                while True:
+                    chunk = list(islice(reader, chunk_size))
+                    if not chunk:
+                        break
+                    cursor.executemany("INSERT INTO students "
+                                       "(nr, name, grade) VALUES (?, ?, ?)",
+                                       chunk)
+                    rows += len(chunk)
+            _migrate(cursor)
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+    finally:
+        connection.isolation_level = isolation_level
+        for pragma, value in previous.items():
+            cursor.execute("PRAGMA %s=%s" % (pragma, value))
+
+    seconds = time.time() - start
+    return {
+        'rows': rows,
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds else 0.0,
+    }
+
 
 def init_db(connection):
     cursor = connection.cursor()
     cursor.execute("CREATE TABLE students (nr TEXT, name TEXT, grade REAL)")
+    migrate_db(connection)
 
     students = [('124356', 'John', 8.6),
                 ('124806', 'Jenny', 4.5),
@@ -76,8 +432,7 @@ def init_db(connection):
                 ('122476', 'Paul', 7.6),
                 ('178356', 'Lemar', 5.6),
                 ('124896', 'Brent', 9)]
-    cursor.executemany("INSERT INTO students VALUES (?, ?, ?)", students)
-    connection.commit()
+    SQLiteHoroscopeDAO(connection).add_students(students)
 
 
 if __name__ == '__main__':
@@ -85,14 +440,30 @@ if __name__ == '__main__':
     init_db(connection)
     dao = SQLiteHoroscopeDAO(connection)
 
-    print "%s's grade will get %s in the future" % dao.grades_tendency('124356')
-    print "%s's grade will get %s in the future" % dao.grades_tendency('124806')
+    print("%s's grade will get %s in the future" %
+          dao.grades_tendency('124356'))
+    print("%s's grade will get %s in the future" %
+          dao.grades_tendency('124806'))
+
+    print("%s students' grades currently over 8 will "
+          "lower in the future" % dao.grade_8_lower_tendency())
 
-    print "%s students' grades currently over 8 will " \
-          "lower in the future" % dao.grade_8_lower_tendency()
+    print("%s will have a %s day" % dao.good_day('124356'))
+    print("%s will have a %s day" % dao.good_day('129956'))
 
-    print "%s will have a %s day" % dao.good_day('124356')
-    print "%s will have a %s day" % dao.good_day('129956')
+    # Same queries, served to an event loop by the async DAO
+    if asyncio is not None:
+        loop = asyncio.new_event_loop()
+        async_dao = AsyncHoroscopeDAO(DB_NAME, loop=loop)
+        results = loop.run_until_complete(asyncio.gather(
+            async_dao.good_day('124356'), async_dao.good_day('129956'),
+            async_dao.grade_8_lower_tendency()))
+        print("(async) %s will have a %s day" % results[0])
+        print("(async) %s will have a %s day" % results[1])
+        print("(async) %s students' grades currently over 8 will "
+              "lower in the future" % results[2])
+        async_dao.close()
+        loop.close()
 
     # Close and also drop database file
     connection.close()
@@ -47,11 +47,11 @@ class _ProxiedMethod(object):
         unmarshalls it and returns the result
         """
 
-        if not hasattr(self.proxy_obj.server, method):
-            raise AttributeError('Method %s is not defined '
-                                 'on %s' % (method, self.proxy_obj.server))
+        if not hasattr(self.proxy_obj.server, self.method):
+            raise AttributeError('Method %s is not defined on '
+                                 '%s' % (self.method, self.proxy_obj.server))
 
-        Requestor.send(Marshaller.marshall(method, *args))
+        Requestor.send(Marshaller.marshall(self.method, *args))
         response = Requestor.receive()
         return Marshaller.unmarshall(response)
 